@@ -25,9 +25,13 @@ from __future__ import annotations
 import argparse
 import dataclasses
 import datetime as dt
+import mmap
+import os
+import re
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List, Tuple
 
@@ -54,6 +58,42 @@ PATCH_HEADER = (
     "# Do not edit generated sync sections manually unless you also update the script.\n"
 )
 
+# binding_rust/build.rs patch sites and their Arborium replacements.
+BUILD_RS_WASM_GATE = """if target.starts_with("wasm32-unknown") {
+        configure_wasm_build(&mut config);
+    }"""
+
+BUILD_RS_WASM_GATE_PATCHED = """if target.starts_with("wasm32-unknown") {
+        let mut arborium_has_sysroot = false;
+
+        // Arborium patch: prefer arborium-sysroot and disable upstream wasm stdlib
+        // sources to avoid duplicate symbols (malloc/free/...).
+        if let Ok(sysroot) = env::var("DEP_ARBORIUM_SYSROOT_PATH") {
+            let wasm_sysroot = PathBuf::from(&sysroot);
+            config.include(&wasm_sysroot);
+            println!("cargo:rerun-if-changed={}", wasm_sysroot.display());
+            arborium_has_sysroot = true;
+        }
+
+        if !arborium_has_sysroot {
+            configure_wasm_build(&mut config);
+        }
+    }"""
+
+BUILD_RS_WASM_FLAGS = 'if target.contains("wasm") {'
+
+BUILD_RS_WASM_FLAGS_PATCHED = (
+    'if target.contains("wasm") {\n'
+    "        // Arborium patch: suppress format warnings on wasm32 where\n"
+    "        // uint32_t may be unsigned long.\n"
+    '        config.flag_if_supported("-Wno-format");'
+)
+
+# One alternation over every build.rs patch site, so patching is a single scan.
+BUILD_RS_PATCH_SITES = re.compile(
+    "|".join(map(re.escape, [BUILD_RS_WASM_GATE, BUILD_RS_WASM_FLAGS]))
+)
+
 
 @dataclasses.dataclass
 class CmdResult:
@@ -99,15 +139,24 @@ def die(msg: str, code: int = 1) -> None:
 def ensure_clean_tree(repo_root: Path, allow_dirty: bool) -> None:
     if allow_dirty:
         return
-    res = run(["git", "status", "--porcelain"], cwd=repo_root)
-    if res.out.strip():
+    # Stop reading at the first entry; a dirty tree can list many files.
+    args = ["git", "status", "--porcelain"]
+    with subprocess.Popen(
+        args, cwd=str(repo_root), stdout=subprocess.PIPE, text=True
+    ) as proc:
+        dirty = any(line.strip() for line in proc.stdout)
+    if not dirty and proc.returncode != 0:
+        raise RuntimeError(f"Command failed ({proc.returncode}): {' '.join(args)}")
+    if dirty:
         die(
             "Working tree is not clean. Commit/stash changes or pass --allow-dirty.",
             code=2,
         )
 
 
-def ensure_paths(repo_root: Path, upstream_root: Path, tag: str) -> Tuple[Path, Path]:
+def ensure_paths(
+    repo_root: Path, upstream_root: Path, tag: str
+) -> Tuple[Path, Path, str]:
     target = repo_root / TARGET_REL
     if not target.exists():
         die(f"Target directory not found: {target}")
@@ -120,34 +169,34 @@ def ensure_paths(repo_root: Path, upstream_root: Path, tag: str) -> Tuple[Path,
     if not upstream_lib.exists():
         die(f"Upstream lib directory not found: {upstream_lib}")
 
-    # Verify tag exists.
+    # Verify tag exists and resolve its short rev in the same call. A later
+    # `git fetch --tags` (without --force) never moves an existing tag.
     try:
-        run(
-            ["git", "rev-parse", "-q", "--verify", f"refs/tags/{tag}"],
+        tag_rev_short = run(
+            ["git", "rev-parse", "-q", "--verify", "--short", f"refs/tags/{tag}"],
             cwd=upstream_root,
             check=True,
-        )
+        ).out.strip()
     except RuntimeError:
         die(f"Tag not found in upstream: {tag}")
 
-    return target, upstream_lib
+    return target, upstream_lib, tag_rev_short
 
 
 def checkout_upstream_tag(upstream_root: Path, tag: str, dry_run: bool) -> str:
-    # Save current ref so we can put it back.
-    res = run(
-        ["git", "rev-parse", "--abbrev-ref", "HEAD"], cwd=upstream_root, check=False
-    )
-    current_ref = res.out.strip()
+    # Save current ref so we can put it back. Resolve the full sha and the
+    # branch name in one call; a detached HEAD abbreviates to "HEAD".
+    head_sha, current_ref = run(
+        ["git", "rev-parse", "HEAD", "--abbrev-ref", "HEAD"], cwd=upstream_root
+    ).out.split()
     if current_ref == "HEAD":
-        detached = run(["git", "rev-parse", "HEAD"], cwd=upstream_root).out.strip()
-        current_ref = detached
+        current_ref = head_sha
 
     info(f"Upstream current ref: {current_ref}")
     info(f"Checking out upstream tag: {tag}")
     if not dry_run:
-        run(["git", "fetch", "--tags", "--prune"], cwd=upstream_root)
-        run(["git", "checkout", tag], cwd=upstream_root)
+        run(["git", "fetch", "--tags", "--prune"], cwd=upstream_root, capture=False)
+        run(["git", "checkout", tag], cwd=upstream_root, capture=False)
 
     new_rev = run(
         ["git", "rev-parse", "--short", "HEAD"], cwd=upstream_root
@@ -160,38 +209,108 @@ def restore_upstream_ref(upstream_root: Path, old_ref: str, dry_run: bool) -> No
     info(f"Restoring upstream ref: {old_ref}")
     if dry_run:
         return
-    run(["git", "checkout", old_ref], cwd=upstream_root)
+    run(["git", "checkout", old_ref], cwd=upstream_root, capture=False)
 
 
 def rm_tree(path: Path) -> None:
-    if path.exists():
+    # rmtree already walks with directory fds and unlinkat() where the platform
+    # supports it; just skip the separate existence check.
+    try:
         shutil.rmtree(path)
+    except FileNotFoundError:
+        pass
+
+
+def clone_file(src: str, dst: str) -> None:
+    """
+    Copy a file with `copy_file_range`, which reflinks on CoW filesystems
+    (btrfs/XFS) and copies in-kernel elsewhere. Falls back to `shutil.copy2`.
+
+    Hardlinks are deliberately avoided: patchers rewrite files in place, which
+    would modify the upstream checkout through a shared inode.
+    """
+    try:
+        with open(src, "rb") as s, open(dst, "wb") as d:
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                n = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                if n == 0:
+                    break
+                remaining -= n
+    except (AttributeError, OSError):
+        # No copy_file_range on this platform, or cross-device on old kernels.
+        shutil.copy2(src, dst)
+        return
+    shutil.copystat(src, dst)
 
 
 def copy_tree(src: Path, dst: Path) -> None:
-    if dst.exists():
-        rm_tree(dst)
-    shutil.copytree(src, dst)
+    rm_tree(dst)
+    shutil.copytree(src, dst, copy_function=clone_file)
 
 
 def copy_file(src: Path, dst: Path) -> None:
+    """
+    Copy file contents kernel-side with `sendfile`. Preserved files are
+    restored verbatim, so metadata (mode/times) is not carried over.
+    """
     dst.parent.mkdir(parents=True, exist_ok=True)
-    shutil.copy2(src, dst)
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            offset = 0
+            remaining = os.fstat(s.fileno()).st_size
+            while remaining > 0:
+                n = os.sendfile(d.fileno(), s.fileno(), offset, remaining)
+                if n == 0:
+                    break
+                offset += n
+                remaining -= n
+        except (AttributeError, OSError):
+            # No sendfile, or it only accepts sockets on this platform.
+            s.seek(0)
+            d.seek(0)
+            d.truncate()
+            shutil.copyfileobj(s, d)
 
 
 def backup_preserved(target: Path, backup_dir: Path) -> None:
     backup_dir.mkdir(parents=True, exist_ok=True)
-    for rel in PRESERVE_PATHS:
-        p = target / rel
-        if p.exists():
-            copy_file(p, backup_dir / rel)
+
+    def backup(rel: Path) -> None:
+        try:
+            copy_file(target / rel, backup_dir / rel)
+        except FileNotFoundError:
+            pass
+
+    with ThreadPoolExecutor() as ex:
+        list(ex.map(backup, PRESERVE_PATHS))
 
 
 def restore_preserved(target: Path, backup_dir: Path) -> None:
-    for rel in PRESERVE_PATHS:
-        b = backup_dir / rel
-        if b.exists():
-            copy_file(b, target / rel)
+    def restore(rel: Path) -> None:
+        try:
+            copy_file(backup_dir / rel, target / rel)
+        except FileNotFoundError:
+            pass
+
+    with ThreadPoolExecutor() as ex:
+        list(ex.map(restore, PRESERVE_PATHS))
+
+
+def file_contains(path: Path, needle: bytes) -> bool:
+    """Search raw file bytes without decoding the whole file into a str."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return False
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(needle) != -1
+
+
+def write_if_changed(path: Path, src: str, patched: str) -> bool:
+    if patched == src:
+        return False
+    path.write_text(patched)
+    return True
 
 
 def patch_binding_rust_build_rs(target: Path) -> None:
@@ -205,56 +324,38 @@ def patch_binding_rust_build_rs(target: Path) -> None:
         warn(f"Missing {path}, skipping patch.")
         return
 
-    src = path.read_text()
-
-    if "DEP_ARBORIUM_SYSROOT_PATH" in src:
+    if file_contains(path, b"DEP_ARBORIUM_SYSROOT_PATH"):
         info("build.rs already has arborium sysroot patch.")
         return
 
-    old_gate = """if target.starts_with("wasm32-unknown") {
-        configure_wasm_build(&mut config);
-    }"""
+    src = path.read_text()
 
-    new_gate = """if target.starts_with("wasm32-unknown") {
-        let mut arborium_has_sysroot = false;
+    replacements = {BUILD_RS_WASM_GATE: BUILD_RS_WASM_GATE_PATCHED}
 
-        // Arborium patch: prefer arborium-sysroot and disable upstream wasm stdlib
-        // sources to avoid duplicate symbols (malloc/free/...).
-        if let Ok(sysroot) = env::var("DEP_ARBORIUM_SYSROOT_PATH") {
-            let wasm_sysroot = PathBuf::from(&sysroot);
-            config.include(&wasm_sysroot);
-            println!("cargo:rerun-if-changed={}", wasm_sysroot.display());
-            arborium_has_sysroot = true;
-        }
+    # Keep existing Arborium warning suppression behavior for wasm targets.
+    if 'config.flag_if_supported("-Wno-format");' not in src:
+        replacements[BUILD_RS_WASM_FLAGS] = BUILD_RS_WASM_FLAGS_PATCHED
 
-        if !arborium_has_sysroot {
-            configure_wasm_build(&mut config);
-        }
-    }"""
+    # Patch every site in a single scan, replacing only the first occurrence
+    # of each needle.
+    seen = set()
+
+    def replace_first(m: re.Match[str]) -> str:
+        needle = m.group(0)
+        if needle in seen or needle not in replacements:
+            return needle
+        seen.add(needle)
+        return replacements[needle]
 
-    if old_gate not in src:
+    patched = BUILD_RS_PATCH_SITES.sub(replace_first, src)
+
+    if BUILD_RS_WASM_GATE not in seen:
         warn(
             "Could not find wasm32 configure gate in build.rs; upstream layout may have changed."
         )
         return
 
-    patched = src.replace(old_gate, new_gate, 1)
-
-    # Keep existing Arborium warning suppression behavior for wasm targets.
-    if (
-        'if target.contains("wasm") {' in patched
-        and 'config.flag_if_supported("-Wno-format");' not in patched
-    ):
-        patched = patched.replace(
-            'if target.contains("wasm") {',
-            'if target.contains("wasm") {\n'
-            "        // Arborium patch: suppress format warnings on wasm32 where\n"
-            "        // uint32_t may be unsigned long.\n"
-            '        config.flag_if_supported("-Wno-format");',
-            1,
-        )
-
-    path.write_text(patched)
+    write_if_changed(path, src, patched)
 
 
 def patch_binding_rust_lib_rs_languagefn_reexport(target: Path) -> None:
@@ -267,17 +368,17 @@ def patch_binding_rust_lib_rs_languagefn_reexport(target: Path) -> None:
         warn(f"Missing {path}, skipping LanguageFn re-export patch.")
         return
 
-    src = path.read_text()
-
-    if "pub use tree_sitter_language::LanguageFn;" in src:
+    if file_contains(path, b"pub use tree_sitter_language::LanguageFn;"):
         info("binding_rust/lib.rs already has LanguageFn public re-export.")
         return
 
+    src = path.read_text()
+
     old = "use tree_sitter_language::LanguageFn;"
     new = "pub use tree_sitter_language::LanguageFn;"
 
     if old in src:
-        path.write_text(src.replace(old, new, 1))
+        write_if_changed(path, src, src.replace(old, new, 1))
         info("Patched binding_rust/lib.rs to publicly re-export LanguageFn.")
         return
 
@@ -297,11 +398,12 @@ def patch_clock_h_if_needed(target: Path) -> None:
         info("src/clock.h not present in upstream layout; skipping clock patch.")
         return
 
-    src = path.read_text()
-    if "defined(__wasm__) && !defined(__EMSCRIPTEN__)" in src:
+    if file_contains(path, b"defined(__wasm__) && !defined(__EMSCRIPTEN__)"):
         info("clock.h already has wasm stub branch.")
         return
 
+    src = path.read_text()
+
     needle = "#if defined(_WIN32)"
     if needle not in src:
         warn("clock.h has unexpected format; skipping clock patch.")
@@ -350,8 +452,20 @@ static inline bool clock_is_gt(TSClock self, TSClock other) {
 
 #elif defined(_WIN32)
 """
-    src = src.replace(needle, wasm_block, 1)
-    path.write_text(src)
+    write_if_changed(path, src, src.replace(needle, wasm_block, 1))
+
+
+def apply_patches(target: Path) -> None:
+    # Each patcher touches a different file, so they can run concurrently.
+    patchers = [
+        patch_binding_rust_build_rs,
+        patch_binding_rust_lib_rs_languagefn_reexport,
+        patch_clock_h_if_needed,
+    ]
+    with ThreadPoolExecutor(max_workers=len(patchers)) as ex:
+        futures = [ex.submit(patcher, target) for patcher in patchers]
+        for fut in futures:
+            fut.result()
 
 
 def write_sync_metadata(
@@ -371,8 +485,8 @@ def maybe_commit(repo_root: Path, tag: str, rev: str, do_commit: bool) -> None:
     if not do_commit:
         return
     msg = f"tree-sitter: hard-reset fork from upstream {tag} ({rev}) and reapply arborium patches"
-    run(["git", "add", str(TARGET_REL)], cwd=repo_root)
-    run(["git", "commit", "-m", msg], cwd=repo_root)
+    run(["git", "add", str(TARGET_REL)], cwd=repo_root, capture=False)
+    run(["git", "commit", "-m", msg], cwd=repo_root, capture=False)
     info("Committed changes.")
 
 
@@ -416,7 +530,9 @@ def main() -> None:
     upstream_root = Path(args.upstream).expanduser().resolve()
 
     ensure_clean_tree(repo_root, args.allow_dirty)
-    target, upstream_lib = ensure_paths(repo_root, upstream_root, args.tag)
+    target, upstream_lib, upstream_rev_short = ensure_paths(
+        repo_root, upstream_root, args.tag
+    )
 
     info(f"Repo root: {repo_root}")
     info(f"Target: {target}")
@@ -425,10 +541,6 @@ def main() -> None:
 
     current_ref = checkout_upstream_tag(upstream_root, args.tag, dry_run=dry_run)
     try:
-        upstream_rev_short = run(
-            ["git", "rev-parse", "--short", f"refs/tags/{args.tag}"], cwd=upstream_root
-        ).out.strip()
-
         backup_dir = repo_root / ".cache" / "sync-tree-sitter-backup"
         if dry_run:
             info("Would backup preserved files:")
@@ -448,9 +560,7 @@ def main() -> None:
             info("Would restore preserved files and apply Arborium patches.")
         else:
             restore_preserved(target, backup_dir)
-            patch_binding_rust_build_rs(target)
-            patch_binding_rust_lib_rs_languagefn_reexport(target)
-            patch_clock_h_if_needed(target)
+            apply_patches(target)
             write_sync_metadata(target, args.tag, upstream_rev_short)
 
         summarize_diff(repo_root)